@@ -1,4 +1,5 @@
 import os
+import numpy as np
 import torch
 from torch.utils.data import Dataset, DataLoader, Subset, DistributedSampler
 from torchvision import transforms
@@ -7,7 +8,7 @@ import pickle
 import random
 
 class CustomDataset(Dataset):
-    def __init__(self, image_dir, label_file, transform=None, cache_file='valid_indices_cache.pkl', shuffle=True):
+    def __init__(self, image_dir, label_file, transform=None, cache_file='valid_indices_cache.pkl', shuffle=True, tokenizer=None, max_length=300):
         self.image_dir = image_dir
         self.transform = transform
         self.cache_file = cache_file
@@ -15,6 +16,18 @@ class CustomDataset(Dataset):
             self.labels = f.readlines()
         self.valid_indices = self._load_or_create_valid_indices()
         self.shuffle = True
+        # when a tokenizer is given, tokenize the whole split once up front:
+        # the same labels come around every epoch, so this turns tokenization
+        # from O(epochs x N) into O(N) and __getitem__ just indexes the cache.
+        # Compact dtypes keep the cache small; the collate widens them.
+        if tokenizer is not None:
+            texts = [self.labels[i].strip() for i in self.valid_indices]
+            enc = tokenizer(texts, padding='max_length', truncation=True, max_length=max_length, return_tensors='np')
+            self.input_ids = enc['input_ids'].astype(np.int32)
+            self.attention_mask = enc['attention_mask'].astype(np.uint8)
+        else:
+            self.input_ids = None
+            self.attention_mask = None
 
     def _load_or_create_valid_indices(self):
         if os.path.exists(self.cache_file):
@@ -51,7 +64,9 @@ class CustomDataset(Dataset):
                 transforms.ToTensor()
             ])
             image = transform(image)
-        
+
+        if self.input_ids is not None:
+            return image, self.input_ids[idx], self.attention_mask[idx], label
         return image, label
 
     def resize_and_pad(self, image, target_width, target_height):
@@ -77,14 +92,41 @@ class CustomDataset(Dataset):
 
 
 
+class LatexBatchCollate:
+    """Collate pre-tokenized samples into batch tensors.
+
+    The dataset tokenizes its whole split once in __init__, so collation only
+    stacks the cached token ids and builds the shifted targets. Runs on the
+    worker processes (when num_workers > 0) and returns CPU tensors ready for
+    pinned-memory non_blocking H2D copies.
+    """
+    def __init__(self, pad_token_id):
+        self.pad_token_id = pad_token_id
+
+    def __call__(self, batch):
+        images = torch.stack([item[0] for item in batch])
+        input_ids = torch.from_numpy(np.stack([item[1] for item in batch])).long()
+        attention_mask = torch.from_numpy(np.stack([item[2] for item in batch])).long()
+        latex_labels = [item[3] for item in batch]
+        targets = input_ids.clone()
+        # Shift targets to the right, filling in with pad token
+        targets[:, :-1] = input_ids[:, 1:]
+        targets[:, -1] = self.pad_token_id
+        return images, input_ids, attention_mask, targets, latex_labels
+
+
 class CustomDataLoader:
-    def __init__(self, image_dir, label_file, process_rank, num_processes, transform=None, cache_file='valid_indices_cache.pkl', shuffle=True, batch_size=1, num_workers=1, sampler=None):
-        self.dataset = CustomDataset(image_dir=image_dir, label_file=label_file, transform=transform, cache_file=cache_file)
+    def __init__(self, image_dir, label_file, process_rank, num_processes, transform=None, cache_file='valid_indices_cache.pkl', shuffle=True, batch_size=1, num_workers=1, sampler=None, collate_fn=None, persistent_workers=False, prefetch_factor=2, tokenizer=None, max_length=300):
+        self.dataset = CustomDataset(image_dir=image_dir, label_file=label_file, transform=transform, cache_file=cache_file, tokenizer=tokenizer, max_length=max_length)
         self.batch_size = batch_size
         self.num_workers = num_workers
         self.shuffle = shuffle
         self.process_rank = process_rank
         self.num_processes = num_processes
+        self.collate_fn = collate_fn
+        self.persistent_workers = persistent_workers
+        self.prefetch_factor = prefetch_factor
+        self._dataloader = None
         # Create a DistributedSampler for multi-GPU training
         self.sampler = torch.utils.data.distributed.DistributedSampler(
             self.dataset,
@@ -96,13 +138,20 @@ class CustomDataLoader:
         return len(self.dataset)
 
     def __iter__(self):
-        if self.sampler is not None:
-            dataloader = DataLoader(self.dataset, batch_size=self.batch_size, shuffle=False, num_workers=self.num_workers, 
-                                    sampler=self.sampler, pin_memory=True, )
-        else:
-            dataloader = DataLoader(self.dataset, batch_size=self.batch_size, shuffle=self.shuffle, num_workers=self.num_workers, pin_memory=True)
-        return iter(dataloader)
-    
+        # Build the DataLoader once and reuse it across epochs, otherwise
+        # persistent_workers would respawn worker processes every epoch
+        if self._dataloader is None:
+            kwargs = dict(batch_size=self.batch_size, num_workers=self.num_workers,
+                          pin_memory=True, collate_fn=self.collate_fn)
+            if self.num_workers > 0:
+                kwargs.update(persistent_workers=self.persistent_workers,
+                              prefetch_factor=self.prefetch_factor)
+            if self.sampler is not None:
+                self._dataloader = DataLoader(self.dataset, shuffle=False, sampler=self.sampler, **kwargs)
+            else:
+                self._dataloader = DataLoader(self.dataset, shuffle=self.shuffle, **kwargs)
+        return iter(self._dataloader)
+
     def get_epoch(self):
         return self.sampler.epoch
     
@@ -110,13 +159,13 @@ class CustomDataLoader:
         self.sampler.set_epoch(epoch)
 
 class SubsetCustomDataLoader:
-    def __init__(self, image_dir, label_file, process_rank, num_processes, subset_size, 
-                 transform=None, cache_file='valid_indices_cache.pkl', shuffle=True, 
+    def __init__(self, image_dir, label_file, process_rank, num_processes, subset_size,
+                 transform=None, cache_file='valid_indices_cache.pkl', shuffle=True,
                  sampler=None,
-                 batch_size=1, num_workers=1, seed=42):
+                 batch_size=1, num_workers=1, seed=42, collate_fn=None, persistent_workers=False, prefetch_factor=2, tokenizer=None, max_length=300):
         # Initialize the full dataset
-        self.full_dataset = CustomDataset(image_dir=image_dir, label_file=label_file, 
-                                          transform=transform, cache_file=cache_file)
+        self.full_dataset = CustomDataset(image_dir=image_dir, label_file=label_file,
+                                          transform=transform, cache_file=cache_file, tokenizer=tokenizer, max_length=max_length)
         
         # Create a subset of the dataset
         total_size = len(self.full_dataset)
@@ -133,7 +182,11 @@ class SubsetCustomDataLoader:
         self.shuffle = shuffle
         self.process_rank = process_rank
         self.num_processes = num_processes
-        
+        self.collate_fn = collate_fn
+        self.persistent_workers = persistent_workers
+        self.prefetch_factor = prefetch_factor
+        self._dataloader = None
+
         # Create a DistributedSampler for multi-GPU training
         self.sampler = DistributedSampler(
             self.dataset,
@@ -146,16 +199,22 @@ class SubsetCustomDataLoader:
         return len(self.dataset)
 
     def __iter__(self):
-        if self.sampler is not None:
-            dataloader = DataLoader(
-                self.dataset, 
-                batch_size=self.batch_size, 
+        # Build the DataLoader once and reuse it so persistent workers survive
+        # across epochs
+        if self._dataloader is None:
+            kwargs = dict(batch_size=self.batch_size, num_workers=self.num_workers,
+                          pin_memory=True,  # This can speed up data transfer to GPU
+                          collate_fn=self.collate_fn)
+            if self.num_workers > 0:
+                kwargs.update(persistent_workers=self.persistent_workers,
+                              prefetch_factor=self.prefetch_factor)
+            self._dataloader = DataLoader(
+                self.dataset,
                 shuffle=False,  # Shuffle is handled by DistributedSampler
-                num_workers=self.num_workers, 
                 sampler=self.sampler,
-                pin_memory=True,  # This can speed up data transfer to GPU
+                **kwargs,
             )
-        return iter(dataloader)
+        return iter(self._dataloader)
 
     def get_epoch(self):
         return self.sampler.epoch
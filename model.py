@@ -3,9 +3,12 @@ DenseTeX model architecture
 """
 import math
 import inspect
+from contextlib import nullcontext
 from dataclasses import dataclass
 import torch
 import torch.nn as nn
+import torch.distributed as dist
+from torch.distributed.optim import ZeroRedundancyOptimizer
 from torch.nn import functional as F
 from transformers import AutoTokenizer
 from torchtext.data.metrics import bleu_score
@@ -285,7 +288,7 @@ class GPT(nn.Module):
         return logits, loss
     
 
-    def configure_optimizers(self, weight_decay, learning_rate, betas, device_type):
+    def configure_optimizers(self, weight_decay, learning_rate, betas, device_type, use_zero=False):
 
         # start with all of the candidate parameters
         param_dict = {pn: p for pn, p in self.named_parameters()}
@@ -303,12 +306,24 @@ class GPT(nn.Module):
         num_nodecay_params = sum(p.numel() for p in nodecay_params)
         print(f"num decayed parameter tensors: {len(decay_params)}, with {num_decay_params:,} parameters")
         print(f"num non-decayed parameter tensors: {len(nodecay_params)}, with {num_nodecay_params:,} parameters")
-        # Create AdamW optimizer and use the fused version if it is available
+        # Create AdamW optimizer and use the fused version if it is available:
+        # one update kernel per param group instead of one per parameter tensor.
+        # Failing that, foreach at least batches the per-tensor ops.
         fused_available = 'fused' in inspect.signature(torch.optim.AdamW).parameters
         use_fused = fused_available and device_type == 'cuda'
-        extra_args = dict(fused=True) if use_fused else dict()
-        optimizer = torch.optim.AdamW(optim_groups, lr=learning_rate, betas=betas, **extra_args)
-        print(f"using fused AdamW: {use_fused}")
+        extra_args = dict(fused=True) if use_fused else dict(foreach=True)
+        if use_zero:
+            # ZeRO stage 1: shard the AdamW m/v state across the DDP ranks so
+            # each rank holds (and touches per step) only 1/world_size of it
+            optimizer = ZeroRedundancyOptimizer(optim_groups[0]['params'],
+                                                optimizer_class=torch.optim.AdamW,
+                                                lr=learning_rate, betas=betas,
+                                                weight_decay=weight_decay, **extra_args)
+            optimizer.add_param_group(optim_groups[1])
+            print(f"using ZeroRedundancyOptimizer over AdamW (fused: {use_fused})")
+        else:
+            optimizer = torch.optim.AdamW(optim_groups, lr=learning_rate, betas=betas, **extra_args)
+            print(f"using fused AdamW: {use_fused}")
 
         return optimizer
 
@@ -432,48 +447,61 @@ class CombinedModel(nn.Module):
     
         return input_ids, attention_mask, targets
     
-    def evaluate(self, model , val_loader, device, eval_iters, tokenizer, max_n, gradient_accumulation_steps):
-        """ evaluate the model on the validation set """
+    def evaluate(self, model , val_loader, device, eval_iters, tokenizer, max_n, gradient_accumulation_steps, ddp=False):
+        """ evaluate the model on the validation set
+
+        Runs on every rank: the val_loader's DistributedSampler already shards
+        the data, so each rank evaluates its own shard and the accumulated
+        loss/BLEU are all-reduced at the end.
+        """
         model.eval()
 
         total_loss = 0
         num_batches = 0
         total_bleu = 0
-        
-        for i, (images, latex_labels) in enumerate(val_loader):
-            if i >= eval_iters:
-                break
-            
-            images = images.to(device)
-            
-            # Tokenize LaTeX labels
-            input_ids, attention_mask, targets = self.tokenize_latex(latex_labels, tokenizer=tokenizer, max_length=300)
-            input_ids, attention_mask, targets = input_ids.to(device), attention_mask.to(device), targets.to(device)
-            
-            # Forward pass
-            outputs = model(images=images, targets=targets)
-            loss = outputs[1] if isinstance(outputs, tuple) else outputs.loss
-            if isinstance(outputs, tuple):
-                logits = outputs[0]
-            else :
-                logits = outputs
-
-            tempbleu = 0; count = 0
-            
-            for logit, label in zip(logits, input_ids):
-                pred = torch.multinomial(logit.softmax(dim=-1), num_samples=1)
-                pred = pred[pred != tokenizer.pad_token_id]
-                label = label[label != tokenizer.pad_token_id]
-                predicted_tokens = tokenizer.convert_ids_to_tokens(pred)
-                decoded_label = tokenizer.convert_ids_to_tokens(label)
-                tempbleu += bleu_score([predicted_tokens], [[decoded_label]], max_n=max_n)
-                count +=1
-                
-            total_bleu += tempbleu / count
-            
-            loss = outputs[1] / gradient_accumulation_steps 
-            total_loss += loss.item()
-            num_batches += 1  
+
+        # inference_mode skips autograd version counters / view tracking;
+        # bf16 autocast keeps eval memory traffic in half precision
+        autocast_ctx = torch.amp.autocast(device_type='cuda', dtype=torch.bfloat16) if 'cuda' in str(device) else nullcontext()
+        with torch.inference_mode(), autocast_ctx:
+            for i, (images, input_ids, attention_mask, targets, latex_labels) in enumerate(val_loader):
+                if i >= eval_iters:
+                    break
+
+                # batches arrive pre-tokenized from the DataLoader's collate_fn
+                images = images.to(device, non_blocking=True, memory_format=torch.channels_last)
+                input_ids, attention_mask, targets = input_ids.to(device, non_blocking=True), attention_mask.to(device, non_blocking=True), targets.to(device, non_blocking=True)
+
+                # Forward pass
+                outputs = model(images=images, targets=targets)
+                loss = outputs[1] if isinstance(outputs, tuple) else outputs.loss
+                if isinstance(outputs, tuple):
+                    logits = outputs[0]
+                else :
+                    logits = outputs
+
+                tempbleu = 0; count = 0
+
+                for logit, label in zip(logits, input_ids):
+                    pred = torch.multinomial(logit.float().softmax(dim=-1), num_samples=1)
+                    pred = pred[pred != tokenizer.pad_token_id]
+                    label = label[label != tokenizer.pad_token_id]
+                    predicted_tokens = tokenizer.convert_ids_to_tokens(pred)
+                    decoded_label = tokenizer.convert_ids_to_tokens(label)
+                    tempbleu += bleu_score([predicted_tokens], [[decoded_label]], max_n=max_n)
+                    count +=1
+
+                total_bleu += tempbleu / count
+
+                loss = outputs[1] / gradient_accumulation_steps
+                total_loss += loss.item()
+                num_batches += 1
+
+        if ddp:
+            # combine the per-rank shard statistics
+            stats = torch.tensor([total_loss, total_bleu, num_batches], dtype=torch.float64, device=device)
+            dist.all_reduce(stats, op=dist.ReduceOp.SUM)
+            total_loss, total_bleu, num_batches = stats.tolist()
 
         avg_loss = total_loss / num_batches
         avg_bleu = total_bleu / num_batches
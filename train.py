@@ -18,9 +18,12 @@ $ torchrun --nproc_per_node=8 --nnodes=2 --node_rank=1 --master_addr=123.456.123
 
 import os
 import time
+import atexit
 import datetime
 import math
 from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import torch
 import torch.distributed
 import torch.nn as nn
@@ -31,7 +34,7 @@ from model import GPTConfig, GPT, CombinedModel
 from torchvision import models
 from encoder import PositionalEncoding2D, InputEmbeddings
 from torchvision.models import DenseNet169_Weights
-from dataloader import CustomDataLoader, CustomDataset, SubsetCustomDataLoader, dist_sampler
+from dataloader import CustomDataLoader, CustomDataset, SubsetCustomDataLoader, LatexBatchCollate, dist_sampler
 import wandb
 import warnings
 
@@ -78,19 +81,19 @@ backend = 'nccl' # 'nccl', 'gloo', etc.
 # system
 device = 'cuda' if torch.cuda.is_available() else 'cpu' # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1' etc., or try 'mps' on macbooks
 dtype = 'bfloat16' if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else 'float16' # 'float32', 'bfloat16', or 'float16', the latter will auto implement a GradScaler
-compile = False # use PyTorch 2.0 to compile the model to be faster
+compile = True # use PyTorch 2.0 to compile the transformer blocks to be faster
 # init these up here, can override if init_from='resume' (i.e. from a checkpoint)
 iter_num = 0
 best_val_loss = 1e9
 best_val_bleu = 0.0
-num_workers = 0 # number of DataLoader workers
+num_workers = 4 # number of DataLoader workers, >0 so tokenization/loading overlaps with compute
 num_epochs = 100
 max_length = 300
 max_n = 4 # max n-gram for BLEU score
 subset_size = 300000
 
 # configuration parameters that are allowed to be overridden from command line
-config_keys = [k for k,v in globals().items() if not k.startswith('_') and isinstance(v, (int, float, bool, str))]
+config_keys = tuple(k for k,v in globals().items() if not k.startswith('_') and isinstance(v, (int, float, bool, str)))
 exec(open('configurator.py').read()) # overrides from command line or config file
 config = {k: globals()[k] for k in config_keys} # will be useful for logging
 
@@ -143,10 +146,17 @@ model_args = dict(n_layer=n_layer, n_head=n_head, n_embd=n_embd, block_size=300,
 densenet_model = models.densenet169(weights=DenseNet169_Weights.IMAGENET1K_V1) # change to DEFAULT HERE
 # Remove the final fully connected layer to get the final feature maps
 densenet_model = nn.Sequential(*list(densenet_model.children())[:-1])
+# freeze the ImageNet backbone: it is used as a fixed feature extractor, and
+# with frozen params (and images not requiring grad) autograd skips the whole
+# backbone backward, the dominant cost of the image branch. The positional
+# encoding and projection head added below stay trainable.
+for param in densenet_model.parameters():
+    param.requires_grad_(False)
 densenet_model.add_module('PositionalEncoding2D', PositionalEncoding2D(1664, 12, 25)) # hardcoded this based on denseNet output size
 densenet_model.add_module('InputEmbeddings', InputEmbeddings(1664, GPTConfig.n_embd))
-# Move the DenseNet model to the correct device
-densenet_model = densenet_model.to(device)
+# Move the DenseNet model to the correct device, with weights in NHWC layout
+# so the convs hit the faster tensor-core channels_last kernels
+densenet_model = densenet_model.to(device, memory_format=torch.channels_last)
 
 # Define the GPT model
 gptconf = GPTConfig(**model_args)
@@ -195,39 +205,73 @@ if block_size < model.original_model.config.block_size:
 # move the model to the correct device
 model.to(device)
 
+# loss scaling is only needed for fp16; bf16 has fp32's exponent range, so
+# skip the scaler there and avoid its per-step inf/nan check + implicit sync
+use_scaler = (dtype == 'float16')
 # initialize a GradScaler. If enabled=False scaler is a no-op
-scaler = torch.cuda.amp.GradScaler(enabled=(dtype == 'float16'))
+scaler = torch.cuda.amp.GradScaler(enabled=use_scaler)
 
-# optimizer
-optimizer = gpt_model.configure_optimizers(weight_decay, learning_rate, (beta1, beta2), device_type)
+# optimizer. Under DDP, shard the optimizer state across ranks (ZeRO-1)
+optimizer = gpt_model.configure_optimizers(weight_decay, learning_rate, (beta1, beta2), device_type, use_zero=ddp)
 if init_from == 'resume':
     optimizer.load_state_dict(checkpoint['optimizer'])
 checkpoint = None # free up memory
 
-# compile the model
-# if compile:
-#     print("compiling the model... (takes a ~minute)")
-#     unoptimized_model = gpt_model
-#     model = torch.compile(model) # requires PyTorch 2.0
-
-# wrap model into DDP container
+# compile the model. Compiling the whole CombinedModel regresses under
+# AMP+DDP and fights DDP's gradient bucketing, so compile the GPT transformer
+# blocks individually instead. This must happen before the DDP wrap below so
+# DDP sees the compiled modules.
+if compile and device_type == 'cuda':
+    print("compiling the transformer blocks... (takes a ~minute)")
+    for i, block in enumerate(gpt_model.transformer.h):
+        gpt_model.transformer.h[i] = torch.compile(block, mode='default', dynamic=False) # requires PyTorch 2.0
+
+# wrap model into DDP container. With the DenseNet backbone frozen, every
+# trainable parameter (GPT blocks + projection head) gets a grad on every
+# step, so find_unused_parameters can be off -- that skips the per-backward
+# graph traversal and re-enables DDP's bucketing/overlap optimizations.
+# gradient_as_bucket_view saves the grad->bucket copy in the reducer.
 if ddp:
-    model = DDP(model, device_ids=[ddp_local_rank], find_unused_parameters=True)
+    model = DDP(model, device_ids=[ddp_local_rank], find_unused_parameters=False,
+                gradient_as_bucket_view=True)
 
 
 # Load the tokenizer
 tokenizer = gpt_model.tokenizer
 
-# logging results to a txt file
+# logging results to a txt file. Open the file once with line buffering
+# instead of an open/close syscall pair per message; only the master process
+# writes, so the ranks never race on the same file
+_log_fh = open(log_file, 'a', encoding="utf-8", buffering=1) if master_process else None
+if _log_fh is not None:
+    atexit.register(_log_fh.close)
+
 def log_info(message, also_print=False):
     timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     log_message = f"[{timestamp}] {message}"
-    with open(log_file, 'a', encoding="utf-8") as f:
-        f.write(log_message + '\n')
+    if _log_fh is not None:
+        _log_fh.write(log_message + '\n')
     if also_print:
         print(log_message)
 
 
+# checkpoints are written from a single background thread: the main thread only
+# snapshots the tensors to CPU, so the slow pickle+disk write overlaps with
+# training instead of stalling the master (and with it every NCCL collective)
+checkpoint_saver = ThreadPoolExecutor(max_workers=1)
+
+def save_checkpoint(checkpoint, path):
+    tmp_path = path + '.tmp'
+    torch.save(checkpoint, tmp_path)
+    os.replace(tmp_path, path) # atomic, no torn checkpoint if we crash mid-write
+
+def _report_save_result(future):
+    # surface background write failures (disk full, permissions, ...) that
+    # would otherwise be silently swallowed by the executor
+    if future.exception() is not None:
+        log_info(f"checkpoint save failed: {future.exception()}", also_print=True)
+
+
 if ddp:
     train_sampler, val_sampler = dist_sampler(ddp, ddp_rank, ddp_world_size)
 else:
@@ -246,20 +290,28 @@ else:
 #                               num_workers=num_workers, sampler=val_sampler)
 
 
+# labels are tokenized once inside the datasets; the collate just stacks the
+# cached ids and builds the shifted targets
+collate_fn = LatexBatchCollate(tokenizer.pad_token_id)
+
 # get subset dataloader
-train_loader = SubsetCustomDataLoader(batch_size=batch_size, image_dir='./data/UniMER-1M/images', label_file='./data/UniMER-1M/train.txt', 
+train_loader = SubsetCustomDataLoader(batch_size=batch_size, image_dir='./data/UniMER-1M/images', label_file='./data/UniMER-1M/train.txt',
                                         subset_size=subset_size,
                                         process_rank=ddp_rank if ddp else 0,
                                         num_processes=ddp_world_size if ddp else 1,
-                                        num_workers=num_workers, sampler=train_sampler)
+                                        num_workers=num_workers, sampler=train_sampler,
+                                        collate_fn=collate_fn, persistent_workers=True, prefetch_factor=2,
+                                        tokenizer=tokenizer, max_length=max_length)
 
-val_loader = CustomDataLoader(batch_size=batch_size, image_dir='./data/UniMER-Test/spe/', label_file='./data/UniMER-Test/spe.txt', cache_file='valid_indices_val.pkl', 
+val_loader = CustomDataLoader(batch_size=batch_size, image_dir='./data/UniMER-Test/spe/', label_file='./data/UniMER-Test/spe.txt', cache_file='valid_indices_val.pkl',
                               process_rank=ddp_rank if ddp else 0,
                               num_processes=ddp_world_size if ddp else 1,
-                              num_workers=num_workers, sampler=val_sampler)
+                              num_workers=num_workers, sampler=val_sampler,
+                              collate_fn=collate_fn, persistent_workers=True, prefetch_factor=2,
+                              tokenizer=tokenizer, max_length=max_length)
 
 
-def get_lr(it):
+def _compute_lr(it):
     """Learning rate decay scheduler w cosine warmup"""
     # 1) linear warmup for warmup_iters steps
     if it < warmup_iters:
@@ -269,175 +321,264 @@ def get_lr(it):
         return min_lr
     # 3) in between, use cosine decay down to min learning rate
     decay_ratio = (it - warmup_iters) / (lr_decay_iters - warmup_iters)
-    assert 0 <= decay_ratio <= 1
     coeff = 0.5 * (1.0 + math.cos(math.pi * decay_ratio)) # coeff ranges 0..1
     return min_lr + coeff * (learning_rate - min_lr)
 
+# precompute the whole schedule once (a few MB of float64): the per-iteration
+# lr becomes a single array index instead of a cosine plus branches
+lr_schedule = np.empty(max_iters + 1, dtype=np.float64)
+for _it in range(max_iters + 1):
+    lr_schedule[_it] = _compute_lr(_it)
+
+def get_lr(it):
+    return float(lr_schedule[min(it, max_iters)])
+
 # logging
 if wandb_log and master_process:
     wandb.init(project=wandb_project, name=wandb_run_name, config=config)
 else :
     wandb_log = False
 
-t0 = time.time()
-# set the model to training mode
-for param in model.parameters():
-    param.requires_grad = True
-
-# training looop
-for epoch in range(num_epochs):
-
-    if ddp :
-        train_loader.sampler.set_epoch(epoch)
-        val_loader.sampler.set_epoch(epoch)
-    
-    model.train()
-
-    if master_process:
-        log_info(f"Starting epoch {epoch+1}/{num_epochs}", also_print=True)
-    
-    for batch_idx, (images, latex_labels) in enumerate(train_loader):
-
-        # Get the image embeddings and the latex labels
-        images = images.to(device)
-        
-        # Tokenize LaTeX labels
-        input_ids, attention_mask, targets = model.module.tokenize_latex(latex_labels, tokenizer=tokenizer, max_length=300)
-        input_ids, attention_mask, targets = input_ids.to(device), attention_mask.to(device), targets.to(device)
-        
-        # Determine and set the learning rate for this iteration
-        lr = get_lr(iter_num) if decay_lr else learning_rate
-        # update the learning rate
-        for param_group in optimizer.param_groups:
-            param_group['lr'] = lr
-
-        # Evaluation and checkpointing
-        if iter_num % eval_interval == 0 and master_process:
-            with torch.no_grad():
-                if ddp :
-                    val_loss, val_bleu = model.module.evaluate(model, val_loader, device=device, eval_iters=eval_iters, 
-                                                                       gradient_accumulation_steps=gradient_accumulation_steps, max_n=max_n, tokenizer=tokenizer)
-                else :
-                    val_loss, val_bleu  = model.evaluate(model, val_loader, device=device, eval_iters=eval_iters, 
-                                                                gradient_accumulation_steps=gradient_accumulation_steps, max_n=max_n, tokenizer=tokenizer)
-
-                print(f"step {iter_num} | val loss {val_loss:.4f} | val BLEU {val_bleu:.4f}")
-
-                if wandb_log:
-                    wandb.log({
-                        "iter": iter_num,
-                        "val/loss": val_loss,
-                        "lr": lr,
-                        "val/bleu": val_bleu,
-                        # "val/ppl": math.exp(val_loss),
-                    }, step = iter_num)
-
-                # save the model if its the best so far
+# training looop. Wrapped in a function so the per-iteration reads below are
+# LOAD_FASTs on locals instead of global dict probes -- the loop body runs
+# hundreds of thousands of times, so the module-global lookups add up
+def train_loop(iter_num, best_val_loss, best_val_bleu):
+    # freeze the hot-loop config into locals once, up front
+    _gas = gradient_accumulation_steps
+    _ddp = ddp
+    _master = master_process
+    _wandb = wandb_log
+    _log_interval = log_interval
+    _eval_interval = eval_interval
+    _sample_interval = sample_interval
+    _max_iters = max_iters
+    _grad_clip = grad_clip
+    _use_scaler = use_scaler
+    _device = device
+    prev_lr = -1.0
+    # scalars queued for wandb; flushed in a single wandb.log per log window
+    pending = {}
+
+    # unwrap the DDP container once instead of chasing the .module attribute
+    # chain inside the loop; this also keeps the loop body agnostic to the
+    # wrapper (DDP today, FSDP tomorrow)
+    raw_model = model.module if _ddp else model
+    _evaluate = raw_model.evaluate
+    stop = False
+
+    # timing: on CUDA use events recorded at log boundaries so nothing in the
+    # hot path forces a cudaStreamSynchronize; fall back to wall clock on CPU
+    if device_type == 'cuda':
+        start_evt = torch.cuda.Event(enable_timing=True)
+        end_evt = torch.cuda.Event(enable_timing=True)
+        start_evt.record()
+    t0 = time.time()
+
+    for epoch in range(num_epochs):
+
+        if _ddp :
+            train_loader.sampler.set_epoch(epoch)
+            val_loader.sampler.set_epoch(epoch)
+
+        model.train()
+
+        if _master:
+            log_info(f"Starting epoch {epoch+1}/{num_epochs}", also_print=True)
+
+        for batch_idx, (images, input_ids, attention_mask, targets, latex_labels) in enumerate(train_loader):
+
+            # batches arrive pre-tokenized from the DataLoader workers, in pinned
+            # memory, so the H2D copies can overlap with compute
+            images = images.to(_device, non_blocking=True, memory_format=torch.channels_last)
+            input_ids = input_ids.to(_device, non_blocking=True)
+            attention_mask = attention_mask.to(_device, non_blocking=True)
+            targets = targets.to(_device, non_blocking=True)
+
+            # Determine and set the learning rate for this iteration
+            lr = get_lr(iter_num) if decay_lr else learning_rate
+            # only touch the param groups when the lr actually changed
+            if lr != prev_lr:
+                for param_group in optimizer.param_groups:
+                    param_group['lr'] = lr
+                prev_lr = lr
+
+            # Evaluation and checkpointing. Every rank evaluates its own shard of
+            # the validation set (evaluate all-reduces the metrics internally, and
+            # idle ranks would otherwise sit in a NCCL collective until timeout);
+            # only the master process logs and writes the checkpoint
+            if iter_num % _eval_interval == 0:
+                val_loss, val_bleu = _evaluate(model, val_loader, device=_device, eval_iters=eval_iters,
+                                               gradient_accumulation_steps=_gas, max_n=max_n,
+                                               tokenizer=tokenizer, ddp=_ddp)
+
+                if _master:
+                    print(f"step {iter_num} | val loss {val_loss:.4f} | val BLEU {val_bleu:.4f}")
+
+                    if _wandb:
+                        # queue for the next log-boundary flush rather than
+                        # paying a wandb IPC round-trip here
+                        pending.update({
+                            "iter": iter_num,
+                            "val/loss": val_loss,
+                            "lr": lr,
+                            "val/bleu": val_bleu,
+                            # "val/ppl": math.exp(val_loss),
+                        })
+
+                # save the model if its the best so far. the best-so-far tracking
+                # runs on all ranks (the reduced metrics are identical everywhere)
                 if val_loss < best_val_loss or always_save_checkpoint or val_bleu > best_val_bleu:
                     if val_loss < best_val_loss:
                         best_val_loss = val_loss
-                    
+
                     elif val_bleu > best_val_bleu:
                         best_val_bleu = val_bleu
-                    
+
 
                     if iter_num > 0:
-                        checkpoint = {
-                            'model': model.module.state_dict() if ddp else model.state_dict(),
-                            'optimizer': optimizer.state_dict(),
-                            'model_args': model_args,
-                            'best_val_loss': best_val_loss,
-                            'config': config,
-                            'best_val_bleu': best_val_bleu,
-                        }
-                        print(f"saving checkpoint to {out_dir}")
-                        torch.save(checkpoint, os.path.join(out_dir, f'best_model.pt'))
-
-        if iter_num == 0 and eval_only:
+                        if _ddp:
+                            # the optimizer state is sharded; every rank has to
+                            # join the gather that rebuilds it on rank 0
+                            optimizer.consolidate_state_dict(to=0)
+
+                        if _master:
+                            # snapshot all tensors to CPU on the main thread so the
+                            # background writer never races live training state.
+                            # torch.compile prefixes the compiled blocks' keys with
+                            # '._orig_mod'; strip it so the checkpoint loads into a
+                            # freshly built (uncompiled) model on resume/inference
+                            raw_state = raw_model.state_dict()
+                            cpu_state = {k.replace('._orig_mod', ''): v.detach().to('cpu', non_blocking=True) for k, v in raw_state.items()}
+                            opt_state = optimizer.state_dict()
+                            opt_state['state'] = {k: {kk: vv.detach().to('cpu', non_blocking=True) if torch.is_tensor(vv) else vv
+                                                      for kk, vv in s.items()}
+                                                  for k, s in opt_state['state'].items()}
+                            if device_type == 'cuda':
+                                torch.cuda.synchronize() # make sure the D2H copies have landed
+                            checkpoint = {
+                                'model': cpu_state,
+                                'optimizer': opt_state,
+                                'model_args': model_args,
+                                'best_val_loss': best_val_loss,
+                                'config': config,
+                                'best_val_bleu': best_val_bleu,
+                            }
+                            print(f"saving checkpoint to {out_dir}")
+                            save_future = checkpoint_saver.submit(save_checkpoint, checkpoint, os.path.join(out_dir, 'best_model.pt'))
+                            save_future.add_done_callback(_report_save_result)
+
+            if iter_num == 0 and eval_only:
+                break
+
+            # Forward backward update, with optional gradient accumulation
+            loss_accum = torch.zeros((), device=_device)
+            for micro_step in range(_gas):
+                # skip the gradient all-reduce on all but the last micro-step;
+                # no_sync() is the explicit DDP API for this and cuts NCCL traffic
+                # to 1/gradient_accumulation_steps
+                ctx_sync = model.no_sync() if (_ddp and micro_step < _gas - 1) else nullcontext()
+
+                with ctx_sync:
+                    # Forward pass: the whole CombinedModel (DenseNet features +
+                    # GPT) runs under this one autocast region, nothing inside
+                    # re-enters autocast
+                    with ctx:
+                        logits, orig_loss = model(images=images, targets=targets)
+                        # scaled for the backward pass; logging uses orig_loss
+                        loss = orig_loss / _gas
+
+                    # accumulate the loss on-device for logging; the all_reduce
+                    # and .item() sync happen once per log_interval, not here
+                    loss_accum += orig_loss.detach()
+
+                    # Backward pass
+                    if _use_scaler:
+                        scaler.scale(loss).backward()
+                    else:
+                        loss.backward()
+
+            if _use_scaler:
+                # Clip the gradient
+                if _grad_clip != 0.0:
+                    scaler.unscale_(optimizer)
+                    torch.nn.utils.clip_grad_norm_(model.parameters(), _grad_clip, foreach=True)
+
+                # Step the optimizer and scaler if training in fp16
+                scaler.step(optimizer)
+                scaler.update()
+            else:
+                # bf16/fp32 path: no unscale/update bookkeeping needed
+                if _grad_clip != 0.0:
+                    torch.nn.utils.clip_grad_norm_(model.parameters(), _grad_clip, foreach=True)
+                optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+
+            # Timing and logging
+            if iter_num % _log_interval == 0:
+                # per-iteration time averaged over the elapsed log window; this is
+                # the only sync point in the window
+                if device_type == 'cuda':
+                    end_evt.record()
+                    torch.cuda.synchronize()
+                    dt = start_evt.elapsed_time(end_evt) / 1000.0 / (_log_interval if iter_num > 0 else 1)
+                    start_evt, end_evt = end_evt, start_evt # recorded end marks the next window's start
+                else:
+                    t1 = time.time()
+                    dt = (t1 - t0) / (_log_interval if iter_num > 0 else 1)
+                    t0 = t1
+
+                # average the accumulated loss over the window; one collective per
+                # log instead of per micro-step (all ranks must enter the all_reduce)
+                avg_loss = loss_accum / _gas
+                if _ddp:
+                    dist.all_reduce(avg_loss, op=dist.ReduceOp.AVG) # averaging loss across multiple GPUs
+
+                if _master:
+                    # get loss as float. note: this is a CPU-GPU sync point
+                    lossf = avg_loss.item()
+
+                    log_message = f"Epoch {epoch+1} | iter {iter_num} : loss {lossf:.4f} | time {dt*1000:.2f}ms | lr {lr:.6f} | tok/s {tokens_per_iter/dt:.2f}"
+                    print(log_message)
+
+                    if _wandb:
+                        pending["train/loss"] = lossf
+                        # pending["train/ppl"] = math.exp(lossf)
+                        wandb.log(pending, step = iter_num)
+                        pending = {}
+
+
+            # Log sample predictions. Sampling + decode costs a vocab-sized softmax
+            # and a GPU->CPU sync, so only pay for it when we actually log
+            if iter_num % _sample_interval == 0 and _master:
+                with torch.no_grad():
+                    sample_prediction = torch.multinomial(logits[0].float().softmax(dim=-1), num_samples=1)
+                    non_pad_mask = sample_prediction != tokenizer.pad_token_id
+                    decoded_prediction = tokenizer.decode(sample_prediction[non_pad_mask])
+                log_info(f" prediction at iter {iter_num} |  pred : {decoded_prediction}")
+                log_info(f" label : {latex_labels[0]}")
+
+            iter_num += 1
+
+            # termination condition: break out as soon as we hit the target
+            # step, identically on single-GPU and DDP runs, instead of training
+            # through the rest of the epoch
+            if iter_num >= _max_iters:
+                stop = True
+                break
+
+        if _ddp :
+            torch.distributed.barrier() # sync all ranks once per epoch
+
+        if stop:
+            if _master:
+                log_info(f"Reached maximum iterations ({_max_iters}). Stopping training.", also_print=True)
             break
 
-        # Forward backward update, with optional gradient accumulation
-        for micro_step in range(gradient_accumulation_steps):
-            if ddp:
-                model.require_backward_grad_sync = (micro_step == gradient_accumulation_steps - 1)
-            
-            # Forward pass
-            with ctx:
-                outputs = model(images=images, targets=targets)
-                if isinstance(outputs, tuple):
-                    logits, loss = outputs
-                else :
-                    logits, loss = outputs, None
-
-                # Ensure loss is a tensor
-                if not isinstance(loss, torch.Tensor):
-                    loss = torch.tensor(loss, requires_grad=True)
-                # Get the predicted tokens
-                sample_prediction = torch.multinomial(logits[0].softmax(dim=-1), num_samples=1)
-                non_pad_mask = sample_prediction != tokenizer.pad_token_id
-                decoded_prediction = tokenizer.decode(sample_prediction[non_pad_mask])
-                orig_loss = outputs[1]
-
-                # for backward pass not logging
-                loss = outputs[1] / gradient_accumulation_steps
-                loss = loss.to(device)
-
-                # for ddp
-                if ddp :
-                    loss_tensor = orig_loss.clone()
-                    # perform all_reduce
-                    dist.all_reduce(loss_tensor, op=dist.ReduceOp.AVG) # averaging loss across multiple GPUs
-                    # update the loss
-                    avg_loss = loss_tensor
-
-                if wandb_log and master_process:
-                    wandb.log({
-                        "train/loss": avg_loss.item() if ddp else orig_loss.item(),
-                        # "train/ppl": math.exp(avg_loss.item() if ddp else orig_loss.item()),
-                    }, step = iter_num)
-
-            # Backward pass
-            scaler.scale(loss).backward()
-        
-        # Clip the gradient
-        if grad_clip != 0.0:
-            scaler.unscale_(optimizer)
-            torch.nn.utils.clip_grad_norm_(model.parameters(), grad_clip)
-        
-        # Step the optimizer and scaler if training in fp16
-        scaler.step(optimizer)
-        scaler.update()
-        optimizer.zero_grad(set_to_none=True)
-
-        # Timing and logging
-        t1 = time.time()
-        dt = t1 - t0
-        t0 = t1
-
-        if iter_num % log_interval == 0 and master_process:
-            # get loss as float. note: this is a CPU-GPU sync point
-            # scale up to undo the division above, approximating the true total loss (exact would have been a sum)
-            lossf = loss.item() * gradient_accumulation_steps
-
-            log_message = f"Epoch {epoch+1} | iter {iter_num} : loss {lossf:.4f} | time {dt*1000:.2f}ms | lr {lr:.6f} | tok/s {tokens_per_iter/dt:.2f}"
-            print(log_message)
-
-
-        # Log sample predictions
-        if iter_num % sample_interval == 0:
-            log_info(f" prediction at iter {iter_num} |  pred : {decoded_prediction}")
-            log_info(f" label : {latex_labels[0]}")            
-
-        iter_num += 1
-
-    if ddp :
-        torch.distributed.barrier() # sync
-        
-        # termination condition
-        if iter_num > max_iters:
-            log_info(f"Reached maximum iterations ({max_iters}). Stopping training.", also_print=True)
-            break
+    return iter_num
+
 
+iter_num = train_loop(iter_num, best_val_loss, best_val_bleu)
+checkpoint_saver.shutdown(wait=True) # flush any in-flight checkpoint write
 print(f"Training completed. Total iterations: {iter_num}")
 
 if ddp: